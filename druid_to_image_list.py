@@ -5,16 +5,47 @@
 import argparse
 import asyncio
 import logging
-import re
 from pathlib import Path
+from typing import Iterable, TextIO
 
-import aiofiles
 import aiohttp
+import msgspec
 from aiohttp import ClientSession
 
+IMAGE_URL_PREFIX = "https://stacks.stanford.edu/image/iiif/"
+IMAGE_URL_SUFFIX = "/full/full/0/default.jpg"
+
+
+# Only the parts of the IIIF manifest that are actually used are declared here; msgspec
+#  skips everything else when decoding, rather than building it into a tree of dicts.
+class Resource(msgspec.Struct):
+    id: str = msgspec.field(name="@id")
+
+
+class Image(msgspec.Struct):
+    resource: Resource
+
+
+class Canvas(msgspec.Struct):
+    images: list[Image]
+
+
+class Sequence(msgspec.Struct):
+    canvases: list[Canvas]
+
+
+class Manifest(msgspec.Struct):
+    sequences: list[Sequence]
+
+
+async def write_records(output_file: TextIO, queue: asyncio.Queue) -> None:
+    """Write records from `queue` to `output_file` until a `None` sentinel is received."""
+    while (records := await queue.get()) is not None:
+        output_file.write(records)
+
 
 async def write_image_urls_for_druid(
-    output_path: Path, druid: str, session: ClientSession
+    queue: asyncio.Queue, druid: str, session: ClientSession
 ):
     manifest = await get_manifest_for_druid(druid, session)
 
@@ -23,19 +54,17 @@ async def write_image_urls_for_druid(
     image_data = get_image_data_from_manifest(druid, manifest)
 
     logging.info(f"Writing data for {druid} ({len(image_data)} images)")
-    async with aiofiles.open(output_path, "a") as _fh:
-        for url, filename in image_data:
-            await _fh.write(f"{url}\t{filename}\n")
+    await queue.put("".join(f"{url}\t{filename}\n" for url, filename in image_data))
 
 
-async def get_manifest_for_druid(druid: str, session: ClientSession) -> dict | None:
+async def get_manifest_for_druid(druid: str, session: ClientSession) -> Manifest | None:
     """Get the manifest for a given DRUID."""
     try:
         async with session.get(
             f"https://purl.stanford.edu/{druid}/iiif/manifest"
         ) as response:
             if response.status == 200:
-                return await response.json()
+                return msgspec.json.decode(await response.read(), type=Manifest)
             else:
                 logging.fatal("Request failed: %s", response)
     except aiohttp.ClientConnectorError as err:
@@ -44,7 +73,9 @@ async def get_manifest_for_druid(druid: str, session: ClientSession) -> dict | N
     return None
 
 
-def get_image_data_from_manifest(druid: str, manifest: dict) -> list[tuple[str, str]]:
+def get_image_data_from_manifest(
+    druid: str, manifest: Manifest
+) -> list[tuple[str, str]]:
     """
     Get the image URLs from the manifest.
     This function is littered with assertions that make explicit the assumptions I made
@@ -53,19 +84,18 @@ def get_image_data_from_manifest(druid: str, manifest: dict) -> list[tuple[str,
     """
 
     # expect only one sequence
-    assert len(manifest["sequences"]) == 1
+    assert len(manifest.sequences) == 1
 
     image_urls = [
-        image["resource"]["@id"]
-        for canvas in manifest["sequences"][0]["canvases"]
-        for image in canvas["images"]
+        image.resource.id
+        for canvas in manifest.sequences[0].canvases
+        for image in canvas.images
     ]
 
     # expect the same number of image URLs as the number of canvases
     #  (i.e. one image per canvas)
-    assert len(image_urls) == len(manifest["sequences"][0]["canvases"])
+    assert len(image_urls) == len(manifest.sequences[0].canvases)
 
-    pattern = rf"https://stacks.stanford.edu/image/iiif/{druid}/([^/]+)/full/full/0/default.jpg"
     image_data = []
     for url in image_urls:
         # check that all URLs match the expected pattern
@@ -80,15 +110,46 @@ def get_image_data_from_manifest(druid: str, manifest: dict) -> list[tuple[str,
         # the last one is really the kicker -- it's only one druid, but it means that the
         #  pattern must be relaxed considerably.  Ah well, it is what it is...
 
+        assert url.startswith(IMAGE_URL_PREFIX) and url.endswith(
+            IMAGE_URL_SUFFIX
+        ), f"'{url}' does not match expected pattern"
+
+        # with the fixed prefix and suffix removed, all that remains is {druid}/{image_id}
+        url_druid, _, image_id = url[
+            len(IMAGE_URL_PREFIX) : -len(IMAGE_URL_SUFFIX)
+        ].partition("/")
         assert (
-            match := re.match(pattern, url)
+            url_druid == druid and image_id and "/" not in image_id
         ), f"'{url}' does not match expected pattern"
 
-        image_data.append((url, f"{druid}/{match.group(1)}.json"))
+        image_data.append((url, f"{druid}/{image_id}.json"))
 
     return image_data
 
 
+async def write_image_urls_for_druids(
+    queue: asyncio.Queue,
+    druids: Iterable[str],
+    session: ClientSession,
+    concurrency: int,
+) -> None:
+    """Write the image data for each of `druids`, with at most `concurrency` at once."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(druid: str):
+        try:
+            await write_image_urls_for_druid(queue=queue, druid=druid, session=session)
+        finally:
+            semaphore.release()
+
+    # tasks are created only as slots become free, so memory use doesn't grow with the
+    #  number of druids
+    async with asyncio.TaskGroup() as task_group:
+        for druid in druids:
+            await semaphore.acquire()
+            task_group.create_task(run(druid))
+
+
 async def main():
     """Command-line entry-point."""
 
@@ -113,6 +174,13 @@ async def main():
         default=False,
         help="Overwrite output file if it already exists",
     )
+    parser.add_argument(
+        "--concurrency",
+        action="store",
+        type=int,
+        default=32,
+        help="Maximum number of concurrent manifest requests (default: 32)",
+    )
     parser.add_argument(
         "input", help="Path to a file containing a list of DRUIDs (one per line)"
     )
@@ -120,6 +188,7 @@ async def main():
     args = parser.parse_args()
     input_path = Path(args.input)
     assert input_path.exists(), "Input file does not exist"
+    assert args.concurrency > 0, "Concurrency must be positive integer!"
 
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
@@ -130,6 +199,13 @@ async def main():
     with input_path.open("r") as _fh:
         druids = [line.strip() for line in _fh]
 
+    # drop repeated DRUIDs (keeping the first occurrence of each), so each manifest is
+    #  only fetched -- and its images only written out -- once
+    unique_druids = list(dict.fromkeys(druids))
+    if len(unique_druids) < len(druids):
+        logging.info("Skipping %d duplicate DRUIDs", len(druids) - len(unique_druids))
+        druids = unique_druids
+
     if args.output is not None:
         output_path = Path(args.output)
     else:
@@ -145,22 +221,39 @@ async def main():
             )
             raise SystemExit(0)
 
-    async with ClientSession() as session:
-        await asyncio.gather(
-            *(
-                write_image_urls_for_druid(
-                    output_path=output_path, druid=druid, session=session
-                )
-                for druid in druids
+    # open the output file up front, so that an unwritable path fails before any
+    #  manifests are fetched
+    with output_path.open("a", buffering=1 << 20) as _fh:
+        # a single writer task owns the output file, so records are never interleaved
+        queue = asyncio.Queue()
+        writer = asyncio.create_task(write_records(_fh, queue))
+
+        try:
+            # all requests go to the same host, so the per-host limit (rather than
+            #  aiohttp's default overall limit of 100) is what should match the
+            #  requested concurrency
+            connector = aiohttp.TCPConnector(
+                limit=0, limit_per_host=args.concurrency, ttl_dns_cache=600
             )
-        )
+            async with ClientSession(connector=connector) as session:
+                await write_image_urls_for_druids(
+                    queue, druids, session, args.concurrency
+                )
+        finally:
+            await queue.put(None)
+            await writer
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+    except ImportError:  # optional, and not available on Windows
+        uvloop = None
+
     try:
         loop = asyncio.get_running_loop()
     except RuntimeError:
-        loop = asyncio.new_event_loop()
+        loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
 
     asyncio.set_event_loop(loop)
     loop.run_until_complete(main())
@@ -4,15 +4,18 @@
 
 import argparse
 import asyncio
-import base64
 import json
 import logging
 import os
+import random
+from contextlib import AsyncExitStack
 from pathlib import Path
-from typing import Coroutine
+from typing import AsyncIterator, Iterable
 from urllib.parse import urlparse
 
 import aiohttp
+import orjson
+import pybase64
 from aiohttp import ClientSession
 from dotenv import load_dotenv
 from rich.console import Console
@@ -26,6 +29,17 @@ PROCESSES_ENDPOINT = "https://transkribus.eu/processing/v1/processes"
 
 HTRID = 36202  # Model ID for "Print 0.3"
 
+# must be a multiple of 3 so that no padding is emitted mid-stream
+BASE64_CHUNK_SIZE = 48 * 1024
+
+# status polling backs off exponentially (with +/-10% jitter) between these bounds
+POLL_INITIAL_DELAY = 1.0  # seconds
+POLL_MAX_DELAY = 15.0  # seconds
+POLL_BACKOFF_FACTOR = 1.7
+
+# request headers for the processing API, rebuilt only when the access token changes
+auth_headers: dict[str, str] = {}
+
 
 def validate_url(url: str) -> bool:
     """Validate that a URL can be successfully parsed."""
@@ -46,7 +60,7 @@ async def get_api_token(username: str, password: str, session: ClientSession) ->
         "client_id": "processing-api-client",
     }
     async with session.post(OIDC_ENDPOINT + "/token", data=data) as response:
-        return await response.json()
+        return orjson.loads(await response.read())
 
 
 async def refresh_api_token(session: ClientSession) -> dict:
@@ -58,7 +72,7 @@ async def refresh_api_token(session: ClientSession) -> dict:
         "refresh_token": token["refresh_token"],
     }
     async with session.post(OIDC_ENDPOINT + "/token", data=data) as response:
-        return await response.json()
+        return orjson.loads(await response.read())
 
 
 async def revoke_api_token(refresh_token: str, session: ClientSession) -> None:
@@ -78,12 +92,46 @@ async def revoke_api_token(refresh_token: str, session: ClientSession) -> None:
         logging.fatal("Connection error: %s", str(err))
 
 
-def get_image_as_base64(image_path: Path) -> str:
-    """Get the image file at the given `image_path` and encode it as a base64 string."""
+async def iter_file_chunks(image_path: Path) -> AsyncIterator[bytes]:
+    """Read the image file at the given `image_path` one chunk at a time."""
     with image_path.open("rb") as _fh:
-        encoded_string = base64.b64encode(_fh.read())
+        while chunk := _fh.read(BASE64_CHUNK_SIZE):
+            yield chunk
 
-    return encoded_string.decode("utf-8")
+
+def stream_request_body_with_base64(
+    request_body: dict, image_chunks: AsyncIterator[bytes], image_size: int | None
+) -> tuple[AsyncIterator[bytes], int | None]:
+    """
+    Stream the JSON `request_body` with the image read from `image_chunks` embedded in
+    it as base64.  The image is encoded one chunk at a time as the body is sent, so
+    neither the raw nor the encoded image is ever held in memory in full.  Returns the
+    body, and its length in bytes (if `image_size` is known).
+    """
+    # base64 never needs escaping in JSON, so the encoded image can be spliced between
+    #  the serialized parts of the request body either side of it
+    request_body["image"]["base64"] = ""
+    prefix, suffix = orjson.dumps(request_body).split(b'"base64":""')
+    prefix += b'"base64":"'
+    suffix = b'"' + suffix
+
+    length = None
+    if image_size is not None:
+        length = len(prefix) + 4 * ((image_size + 2) // 3) + len(suffix)
+
+    async def body() -> AsyncIterator[bytes]:
+        yield prefix
+        # only whole 3-byte groups can be encoded without padding, so carry any
+        #  leftover bytes over to the next chunk
+        remainder = b""
+        async for chunk in image_chunks:
+            chunk = remainder + chunk
+            end = len(chunk) - len(chunk) % 3
+            remainder = chunk[end:]
+            yield pybase64.b64encode(chunk[:end])
+        yield pybase64.b64encode(remainder) + suffix
+
+    return body(), length
 
 
 async def submit_image_for_processing(
@@ -96,52 +144,92 @@ async def submit_image_for_processing(
         "image": {},
     }
 
-    if isinstance(image, str) and image.startswith("http"):
+    is_url = isinstance(image, str) and image.startswith("http")
+    if is_url:
         assert validate_url(image), f"'{image}' is not a valid URL"
-        request_body["image"]["imageUrl"] = image
     else:
         image = Path(image)
         assert image.exists(), f"Image file '{image}' does not exist"
-        request_body["image"]["base64"] = get_image_as_base64(image)
-
-    headers = {"Authorization": f"Bearer {token['access_token']}"}
 
     try:
-        async with session.post(
-            PROCESSES_ENDPOINT,
-            json=request_body,
-            headers=headers,
-        ) as response:
-            if response.status == 200:
-                return (await response.json())["processId"]
-            elif response.status == 429:
-                logging.error("Image submission request failed: no more credits!")
-                no_credits = True
+        async with AsyncExitStack() as stack:
+            # serialize with orjson rather than via `json=`, which would use the stdlib
+            #  encoder
+            if is_url and not upload_image_urls:
+                request_body["image"]["imageUrl"] = image
+                data = aiohttp.BytesPayload(
+                    orjson.dumps(request_body), content_type="application/json"
+                )
+                headers = auth_headers
             else:
-                logging.fatal("Image submission request failed: %s", response)
-    except aiohttp.ClientConnectorError as err:
-        logging.fatal("Connection error: %s", str(err))
+                # the API only accepts uploaded images as base64 within the JSON body
+                #  (there is no multipart upload), so stream the body rather than
+                #  building it in memory
+                if is_url:
+                    # pipe the downloaded image straight into the upload
+                    image_response = await stack.enter_async_context(session.get(image))
+                    if image_response.status != 200:
+                        logging.fatal("Image request failed: %s", image_response)
+                        return None
+                    image_chunks = image_response.content.iter_chunked(
+                        BASE64_CHUNK_SIZE
+                    )
+                    # a compressed response's length won't match the decompressed image
+                    image_size = (
+                        image_response.content_length
+                        if "Content-Encoding" not in image_response.headers
+                        else None
+                    )
+                else:
+                    image_chunks = iter_file_chunks(image)
+                    image_size = image.stat().st_size
+
+                data, length = stream_request_body_with_base64(
+                    request_body, image_chunks, image_size
+                )
+                headers = {**auth_headers, "Content-Type": "application/json"}
+                if length is not None:
+                    headers["Content-Length"] = str(length)
+
+            async with session.post(
+                PROCESSES_ENDPOINT,
+                data=data,
+                headers=headers,
+            ) as response:
+                if response.status == 200:
+                    return orjson.loads(await response.read())["processId"]
+                elif response.status == 429:
+                    logging.error("Image submission request failed: no more credits!")
+                    no_credits = True
+                else:
+                    logging.fatal("Image submission request failed: %s", response)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        # besides connection errors, a downloaded image may be truncated, or its server
+        #  may disconnect or time out part way through the upload
+        logging.fatal("Request error: %r", err)
+
+    return None
 
 
 async def check_processing_status(
     process_id: str, session: ClientSession
 ) -> dict | None:
     """Check the processing status of a given process ID using the Transkribus API."""
-    headers = {"Authorization": f"Bearer {token['access_token']}"}
-
     try:
         async with session.get(
-            f"{PROCESSES_ENDPOINT}/{process_id}", headers=headers
+            f"{PROCESSES_ENDPOINT}/{process_id}", headers=auth_headers
         ) as response:
-            return await response.json()
+            return orjson.loads(await response.read())
     except aiohttp.ClientConnectorError as err:
         logging.fatal("Connection error: %s", str(err))
 
 
-def write_output(status_response: dict, output_path: Path) -> None:
+async def write_output(status_response: dict, output_path: Path) -> None:
     """Write the output from the processing status response to the given `output_path`."""
-    with output_path.open("w") as _fh:
-        json.dump(status_response, _fh, indent=2)
+    data = orjson.dumps(
+        status_response, option=orjson.OPT_INDENT_2 if pretty_output else None
+    )
+    await asyncio.to_thread(output_path.write_bytes, data)
 
 
 async def process_image(
@@ -161,11 +249,18 @@ async def process_image(
 
     output_path = Path(output_path)
 
-    if output_path.exists():
-        logging.debug("%s -- output file already exists: skipping", output_path)
+    if output_path in claimed_outputs:
+        logging.debug(
+            "%s -- output already exists or is claimed by another task: skipping",
+            output_path,
+        )
         counts["skipped"] += 1
         return
 
+    # claim the output before the first `await`, so that a duplicate task can't also
+    #  pass the check above while this one is still running
+    claimed_outputs.add(output_path)
+
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
     logging.info(f"Submitting {image} for processing...")
@@ -176,15 +271,16 @@ async def process_image(
         return
     logging.info(f"Successfully submitted {image} for processing (pid: {process_id})")
 
+    delay = POLL_INITIAL_DELAY
     status_response = await check_processing_status(process_id, session)
-    await asyncio.sleep(5)
     while status_response is not None and status_response.get("status", None) in [
         "CREATED",
         "WAITING",
         "RUNNING",
     ]:
         logging.debug(status_response)
-        await asyncio.sleep(5)
+        await asyncio.sleep(delay * random.uniform(0.9, 1.1))
+        delay = min(POLL_MAX_DELAY, delay * POLL_BACKOFF_FACTOR)
         status_response = await check_processing_status(process_id, session)
 
     if (
@@ -192,7 +288,7 @@ async def process_image(
         and status_response.get("status", None) == "FINISHED"
     ):
         logging.info("Success -- writing output to %s", output_path)
-        write_output(status_response, Path(output_path))
+        await write_output(status_response, output_path)
         counts["processed"] += 1
     else:
         logging.fatal("Processing failed? Image: %s Process ID: %s", image, process_id)
@@ -200,6 +296,29 @@ async def process_image(
         counts["failed"] += 1
 
 
+def find_existing_outputs(
+    output_folder: Path, output_paths: Iterable[str]
+) -> set[Path]:
+    """
+    Collect the paths of all files already in `output_folder` with a single recursive
+    scan, plus any of the given `output_paths` (relative to `output_folder`) that
+    already exist outside of it.
+    """
+    existing_outputs = {
+        Path(root, filename)
+        for root, _, filenames in os.walk(output_folder, followlinks=True)
+        for filename in filenames
+    }
+
+    # absolute paths, or ones using "..", can point outside the scanned folder
+    for output_path in map(Path, output_paths):
+        if output_path.is_absolute() or ".." in output_path.parts:
+            if (output_folder / output_path).exists():
+                existing_outputs.add(output_folder / output_path)
+
+    return existing_outputs
+
+
 async def token_refresh_task(session: ClientSession):
     """Refresh the access token in the background when it is close to expiring."""
     global token
@@ -212,17 +331,30 @@ async def token_refresh_task(session: ClientSession):
         assert "access_token" in token, "Failed to refresh access token: " + json.dumps(
             token
         )
+        auth_headers["Authorization"] = f"Bearer {token['access_token']}"
 
 
-async def gather_with_concurrency(n: int, *coroutines: Coroutine) -> list:
-    """Use asyncio.Semaphore to limit the number of concurrent coroutines to `n`."""
-    semaphore = asyncio.Semaphore(n)
+async def process_images(
+    image_tasks: Iterable[tuple[str, str]],
+    output_folder: Path,
+    session: ClientSession,
+    concurrency: int,
+) -> None:
+    """Process the given `image_tasks`, with at most `concurrency` running at once."""
+    semaphore = asyncio.Semaphore(concurrency)
 
-    async def sem_coroutine(coroutine):
-        async with semaphore:
-            return await coroutine
+    async def run(image: str, output_path: Path):
+        try:
+            await process_image(image=image, output_path=output_path, session=session)
+        finally:
+            semaphore.release()
 
-    return await asyncio.gather(*(sem_coroutine(c) for c in coroutines))
+    # tasks are created only as slots become free, so memory use doesn't grow with the
+    #  number of image tasks
+    async with asyncio.TaskGroup() as task_group:
+        for image, output_path in image_tasks:
+            await semaphore.acquire()
+            task_group.create_task(run(image, output_folder / output_path))
 
 
 async def main():
@@ -256,6 +388,18 @@ async def main():
         default=None,
         help="Maximum number of tasks to process from the input file (includes skipped/failed tasks) (default: all)",
     )
+    parser.add_argument(
+        "--upload-image-urls",
+        action="store_true",
+        default=False,
+        help="Download images given as URLs and upload them to the API, rather than having the API fetch them (e.g. for images that are not publicly accessible)",
+    )
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        default=False,
+        help="Indent the JSON responses written to the output folder (default: compact)",
+    )
     parser.add_argument(
         "image_tasks",
         metavar="image-tasks",
@@ -295,24 +439,54 @@ async def main():
     output_folder = Path(args.output_folder)
     output_folder.mkdir(parents=True, exist_ok=True)
 
+    # every record is checked here, before anything is submitted, so that a malformed
+    #  line can't abort the batch part way through
+    image_tasks = []
     with open(args.image_tasks, "r") as _fh:
-        image_tasks = [line.strip().split() for line in _fh if line.strip()]
+        for line_number, line in enumerate(_fh, start=1):
+            # str.split() with no separator already discards surrounding whitespace
+            if not (fields := line.split()):
+                continue
+            if len(fields) != 2:
+                logging.fatal(
+                    "Line %d of '%s' is not of the form: <image> <output path>",
+                    line_number,
+                    args.image_tasks,
+                )
+                raise SystemExit(1)
+            image_tasks.append(fields)
 
     if args.limit is not None:
         image_tasks = image_tasks[: args.limit]
 
-    global counts, no_credits
+    global counts, no_credits, claimed_outputs, upload_image_urls, pretty_output
     counts = {
         "processed": 0,
         "failed": 0,
         "skipped": 0,
     }
     no_credits = False
+    upload_image_urls = args.upload_image_urls
+    pretty_output = args.pretty
+    # scan the output folder once up front, rather than checking each task's output file;
+    #  tasks then add their own outputs to the set as they start
+    claimed_outputs = find_existing_outputs(
+        output_folder, (output_path for _, output_path in image_tasks)
+    )
 
     # The Transkribus API appears to limit the duration of a TCP connection to
     #  ~10 seconds.  Using a custom TCPConnector we can disable http keep-alive
     #  to use new connections where needed and prevent unexpected closures.
-    connector = aiohttp.TCPConnector(force_close=True)
+    #  Every task holds at most one connection at a time (two when piping a
+    #  downloaded image into its upload), so size the pool to match (plus one for
+    #  token refreshes), and cache DNS lookups since each short-lived connection
+    #  would otherwise re-resolve the host.
+    connections_per_task = 2 if args.upload_image_urls else 1
+    connector = aiohttp.TCPConnector(
+        force_close=True,
+        limit=args.concurrency * connections_per_task + 1,
+        ttl_dns_cache=600,
+    )
     async with ClientSession(connector=connector) as session:
         logging.info("Getting access token...")
         global token
@@ -320,21 +494,12 @@ async def main():
         assert "access_token" in token, "Failed to get access token: " + json.dumps(
             token
         )
+        auth_headers["Authorization"] = f"Bearer {token['access_token']}"
 
         loop = asyncio.get_event_loop()
         loop.create_task(token_refresh_task(session))
 
-        await gather_with_concurrency(
-            args.concurrency,
-            *(
-                process_image(
-                    image=image,
-                    output_path=output_folder / output_path,
-                    session=session,
-                )
-                for image, output_path in image_tasks
-            ),
-        )
+        await process_images(image_tasks, output_folder, session, args.concurrency)
 
         logging.info("Revoking API tokens...")
         await revoke_api_token(token["refresh_token"], session)
@@ -349,10 +514,15 @@ async def main():
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+    except ImportError:  # optional, and not available on Windows
+        uvloop = None
+
     try:
         loop = asyncio.get_running_loop()
     except RuntimeError:
-        loop = asyncio.new_event_loop()
+        loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
 
     asyncio.set_event_loop(loop)
     loop.run_until_complete(main())